@@ -24,13 +24,19 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 import sys
+import re
+import json
 import subprocess as sp
-from os import listdir, chdir, mkdir, remove
-from os.path import abspath, basename, dirname, isdir, isfile, join, realpath, split
-from shutil import which
+from os import listdir, chdir, mkdir, makedirs, remove, replace, cpu_count, walk, stat
+from os.path import abspath, basename, dirname, getsize, isdir, isfile, join, realpath, relpath, split
+from shutil import which, rmtree
+from math import ceil, floor
 import mutagen as mg
 from time import strftime
 import tempfile as tmp
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
 
 scriptdir = dirname(realpath(__file__))
 
@@ -38,6 +44,7 @@ quiet = False
 verbose = False
 force = False
 ffmpeg = which("ffmpeg")
+ffprobe = which("ffprobe")
 splitflac = which("split2flac")
 sofafile = join(scriptdir, "ClubFritz11.sofa")
 fileext = ".flac"
@@ -46,10 +53,13 @@ convfile = "concat_b.flac"
 listfile = "filelist.txt"
 cuefile = "cuesheet.cue"
 logfile = "binauralconv.log"
+probecache = "probecache.json"
 sofagain = 13
 sofagainstep = 1.0
 eqdelay = 0.2
 layout = "5.1"
+autolayout = True
+upmix = False
 generatelfe = False
 lfemultiplier = 1.0
 subboost = True
@@ -65,6 +75,19 @@ sofalizer = False
 resampler = "soxr"
 outsamplerate=48000
 filter_append = ""
+jobs = cpu_count() or 1
+segmentjobs = None
+previewdir = "preview"
+previewcount = 2
+previewlength = 20.0
+sweep = {}
+silencebypass = True
+silencethreshold = -150.0
+silenceminlen = 10.0
+silencemap = None
+segmentminlen = 60
+trackgain = True
+trackgains = {}
 
 class Logger ():
 	def __init__ (self):
@@ -105,7 +128,14 @@ def isint (x):
 	except ValueError:
 		return False
 
-def filtergraph (volume=None):
+def isyes (x):
+	if x.lower() in ("yes", "y", "true", "on", "1"):
+		return True
+	elif x.lower() in ("no", "n", "false", "off", "0"):
+		return False
+	raise ValueError("Not a yes/no value: %s" % x)
+
+def filtergraph (volume=None, analyze=True):
 	if sofalizer:
 		speakers51 = "speakers=FL 30 0|FR 330 0|FC 0 0|BL 120 0|BR 240 0|BC 180 0"
 		speakers40 = "speakers=FL 45 0|FR 315 0|FC 0 0|BL 135 0|BR 225 0|BC 180 0"
@@ -182,6 +212,10 @@ def filtergraph (volume=None):
 				"[orig2][BC][LFE2] amerge=inputs=3,pan=6.1|" + \
 				"FL=c0|FR=c1|FC=c2|LFE={lfemultiplier}*c3|BC=c4|SL=c5|SR=c6").format(eqdelay=eqdelay, lfemultiplier=lfemultiplier)
 	
+	if upmix:
+		# Let FFmpeg map inputs with fewer channels onto the expected layout
+		pan = "aformat=channel_layouts=%s," % ("7.1" if layout == "7.1" else "5.1") + pan
+	
 	if subboost:
 		subeq = "entry(20,2);entry(40,1);entry(55,1.5);entry(60,2.5);entry(75,1);entry(85,0.5);"
 	else:
@@ -218,8 +252,8 @@ def filtergraph (volume=None):
 		graph += ",%s" % filter_append
 
 	if volume is not None and isfloat(volume):
-		graph += ",%s" % oufiltergraph(volume)
-	else:
+		graph += ",%s" % outfiltergraph(volume)
+	elif analyze:
 		graph += ",volumedetect,replaygain"
 	return graph
 
@@ -230,8 +264,10 @@ def outfiltergraph (volume):
 	graph += ",aresample={outsamplerate}:resampler={resampler}:precision=28".format(resampler=resampler, outsamplerate=outsamplerate)
 	return graph
 
-def process (args, linefunc=None, exitcodes=(0,)):
+def process (args, linefunc=None, exitcodes=(0,), running=None):
 	proc = sp.Popen(args, stdout=sp.PIPE, stderr=sp.STDOUT, stdin=sp.DEVNULL)
+	if running is not None:
+		running.add(proc)
 	err = ""
 	for line in iter(proc.stdout.readline,b''):
 		l = line.decode().rstrip()
@@ -241,11 +277,14 @@ def process (args, linefunc=None, exitcodes=(0,)):
 		if linefunc is not None:
 			linefunc(proc, l)
 	proc.wait()
-	if proc.returncode not in exitcodes:
+	if running is not None:
+		running.discard(proc)
+	if exitcodes is not None and proc.returncode not in exitcodes:
 		msg = "Process ended unexpectedly (return code %s)" % proc.returncode
 		if not verbose:
 			msg += ":\n%s" % err
 		fatal(msg)
+	return proc.returncode
 
 def filelist ():
 	files = sorted([join(path, f) for f in listdir(path) if isfile(join(path, f)) and f[-len(fileext):].lower() == fileext])
@@ -253,6 +292,131 @@ def filelist ():
 		fatal("No %s files found in %s" % (fileext, path))
 	return files
 
+def probe (filename):
+	args = [ffprobe, "-v", "error", "-select_streams", "a:0", "-show_entries",
+		"stream=codec_name,sample_rate,channels,channel_layout,sample_fmt,bits_per_sample,bits_per_raw_sample:format=duration",
+		"-of", "json", filename]
+	# Keep stderr apart, so that warnings about the stream don't end up in the JSON
+	proc = sp.run(args, stdout=sp.PIPE, stderr=sp.PIPE, stdin=sp.DEVNULL)
+	err = proc.stderr.decode().rstrip()
+	if verbose and err:
+		print(err)
+	if proc.returncode != 0:
+		fatal("Could not probe %s (return code %s):\n%s" % (filename, proc.returncode, err))
+	try:
+		info = json.loads(proc.stdout.decode())
+	except ValueError:
+		fatal("Could not parse stream info of %s" % filename)
+	if not info.get("streams"):
+		fatal("No audio stream found in %s" % filename)
+	
+	stream = info["streams"][0]
+	bits = int(stream.get("bits_per_raw_sample") or stream.get("bits_per_sample") or 0)
+	return {
+		"codec": stream.get("codec_name"),
+		"samplerate": int(stream.get("sample_rate") or 0),
+		"channels": int(stream.get("channels") or 0),
+		"layout": stream.get("channel_layout") or "unknown",
+		"depth": "%d bit" % bits if bits else stream.get("sample_fmt"),
+		"duration": float(info.get("format", {}).get("duration") or 0),
+	}
+
+def probeall (files):
+	cache = {}
+	if isfile(probecache):
+		try:
+			with open(probecache) as f:
+				cache = json.load(f)
+		except Exception as e:
+			log("Could not read probe cache, ignoring: %s" % repr(e))
+	
+	keys = {}
+	for f in files:
+		if not isfile(f):
+			fatal("Input file not found: %s" % f)
+		st = stat(f)
+		keys[f] = [st.st_mtime, st.st_size]
+	stale = [f for f in files if f not in cache or cache[f]["key"] != keys[f] or force]
+	if stale:
+		log("Probing %d of %d file(s)..." % (len(stale), len(files)))
+		with ThreadPoolExecutor(max_workers=jobs) as executor:
+			for f, info in zip(stale, executor.map(probe, stale)):
+				cache[f] = {"key": keys[f], "info": info}
+		try:
+			with open(probecache, "w") as f:
+				json.dump(cache, f, indent=1)
+		except Exception as e:
+			log("Could not write probe cache: %s" % repr(e))
+	return [cache[f]["info"] for f in files]
+
+# FFmpeg channel layouts that can be converted: name -> (speaker layout, has LFE).
+# Anything that isn't exactly 5.1 or 7.1 is upmixed to the layout the filter
+# graph expects, with the missing channels left silent.
+inputlayouts = {
+	"quad":           ("4.0", False),
+	"quad(side)":     ("4.0", False),
+	"4.0":            ("5.1", False),
+	"4.1":            ("5.1", True),
+	"5.0":            ("5.1", False),
+	"5.0(side)":      ("5.1", False),
+	"5.1":            ("5.1", True),
+	"5.1(side)":      ("5.1", True),
+	"6.0":            ("7.1", False),
+	"hexagonal":      ("7.1", False),
+	"6.1":            ("7.1", True),
+	"6.1(back)":      ("7.1", True),
+	"7.0":            ("7.1", False),
+	"7.1":            ("7.1", True),
+	"7.1(wide)":      ("7.1", True),
+	"7.1(wide-side)": ("7.1", True),
+}
+
+def preflight (files):
+	global layout, upmix, generatelfe
+	
+	infos = probeall(files)
+	
+	def check (key, what, fail=True):
+		values = {}
+		for f, i in zip(files, infos):
+			values.setdefault(str(i[key]), basename(f))
+		if len(values) > 1:
+			msg = "Mixed %s in input: %s" % (what, ", ".join("%s (%s)" % v for v in sorted(values.items())))
+			if fail:
+				fatal(msg)
+			log("Warning: " + msg)
+	
+	check("channels", "channel counts")
+	check("layout", "channel layouts")
+	check("samplerate", "sampling rates")
+	check("depth", "bit depths", False)
+	if len(files) > 1:
+		check("codec", "codecs")
+	
+	for f, i in zip(files, infos):
+		if i["duration"] <= 0:
+			fatal("Could not determine duration of %s" % f)
+	
+	name = infos[0]["layout"]
+	if name not in inputlayouts:
+		fatal("Unsupported input channel layout: %s (%d channel(s)); use --no-preflight to convert anyway" % (name, infos[0]["channels"]))
+	target, haslfe = inputlayouts[name]
+	
+	if autolayout:
+		layout = target
+	elif target != layout and not (layout == "4.0" and target == "5.1" and haslfe):
+		# A quad mix may come in a 5.1 container, but nothing else fits another layout
+		fatal("Input channel layout %s does not fit the %s layout" % (name, layout))
+	
+	upmix = name != ("7.1" if layout == "7.1" else "5.1")
+	if not haslfe and not generatelfe:
+		log("Input has no LFE channel, enabling --generate-lfe")
+		generatelfe = True
+	
+	log("Input: %d file(s), %s, %d Hz, %s, %d channel(s) (%s), %.1f s" % (len(files),
+		infos[0]["codec"], infos[0]["samplerate"], infos[0]["depth"], infos[0]["channels"],
+		name, sum(i["duration"] for i in infos)))
+
 def mktemp ():
 	global tempfile
 	filehandle, filename = tmp.mkstemp(prefix='binauralconv-', suffix='.wv')
@@ -355,12 +519,203 @@ def makecue ():
 	except Exception as e:
 		fatal("Could not write output to file: %s" % repr(e))
 
+def hrirlength ():
+	# Upper bound in seconds: the impulse responses are 96 kHz stereo float WAVs
+	wavdir = join(scriptdir, "wavs")
+	return max(getsize(join(wavdir, f)) for f in listdir(wavdir)) / (96000 * 2 * 4)
+
+def cansegment ():
+	# The tail length is only known for the bundled HRIRs (a SOFA set may be
+	# a long room response), and appended filters may have long memory or
+	# change the timeline
+	return not sofalizer and not filter_append
+
+def latency ():
+	# HRIR plus two chained linear-phase firequalizers (2 * eqdelay long each),
+	# with some headroom for the resamplers, in whole seconds
+	return ceil(hrirlength() + 4 * eqdelay + 0.1)
+
+def silences (filename):
+	regions = []
+	
+	def parseline (proc, l):
+		if "silence_start" in l:
+			regions.append([max(0.0, float(l.split(" ")[-1])), None])
+		elif "silence_end" in l and regions:
+			regions[-1][1] = float(l.split("silence_end: ")[1].split(" ")[0])
+	
+	args = [ffmpeg, "-nostats", "-i", filename, "-af",
+		"silencedetect=noise=%sdB:d=%s" % (silencethreshold, silenceminlen), "-f", "null", "-"]
+	process(args, parseline)
+	return regions
+
+def length (filename):
+	# Prefer the (cached) FFprobe duration, which also covers containers
+	# that mutagen can't read
+	if ffprobe and which(ffprobe):
+		return probeall([realpath(filename)])[0]["duration"]
+	try:
+		return mg.File(filename).info.length
+	except Exception:
+		return None
+
+def segments (filename):
+	global silencemap
+	
+	if not cansegment() or (not silencebypass and segmentjobs < 2):
+		return None
+	
+	duration = length(filename)
+	if not duration:
+		log("Could not determine duration of %s, converting in a single pass" % filename)
+		return None
+	
+	# Segment boundaries are whole seconds, so they fall on exact sample
+	# positions at every common sampling rate. The last segment always runs
+	# until EOF, so that the output length matches a single-pass conversion.
+	overlap = latency()
+	plan = []
+	start = 0
+	if silencebypass:
+		if silencemap is None:
+			log("Detecting silence...")
+			silencemap = silences(filename)
+		
+		# Each segment keeps going until the filter tails have decayed. The
+		# next one starts a second early, since silencedetect may log the
+		# end of silence rounded to a couple of decimals (or even upwards).
+		for s, e in silencemap:
+			e = duration if e is None else e
+			end = ceil(s + overlap)
+			nextstart = floor(min(e, duration)) - 1
+			if nextstart - max(start, end) < 1:
+				continue
+			if s > start:
+				plan.append((start, end))
+			start = nextstart
+	plan.append((start, None))
+	
+	# Split long segments into chunks for parallel conversion. Chunks after
+	# the first one are decoded from a little earlier, and all but the last
+	# one a little past their end (see convert()), so that the filters -
+	# including the non-causal resamplers - see the same input around each
+	# seam as in a single pass once the overlap is dropped.
+	active = sum((duration if end is None else end) - start for start, end in plan)
+	size = max(segmentminlen, ceil(active / segmentjobs))
+	chunks = []
+	for start, end in plan:
+		stop = duration if end is None else end
+		step = ceil((stop - start) / max(1, round((stop - start) / size)))
+		pos = start
+		while stop - pos > step + 1:
+			chunks.append((pos, pos + step, min(overlap, pos) if pos > start else 0))
+			pos += step
+		chunks.append((pos, end, min(overlap, pos) if pos > start else 0))
+	
+	if chunks == [(0, None, 0)]:
+		return None
+	return chunks
+
+def convert (graph, analysis, outfile, outargs, linefunc=None, exitcodes=(0,)):
+	plan = segments(concatfile)
+	if plan is None:
+		args = [ffmpeg, "-i", concatfile, "-af", ",".join(filter(None, (graph, analysis)))] + outargs + [outfile]
+		return process(args, linefunc, exitcodes) == 0
+	
+	skipped = plan[0][0] + sum(plan[i+1][0] - plan[i][1] for i in range(len(plan) - 1))
+	log("Converting %d segment(s) using %d job(s), bypassing %d s of silence" % (len(plan), segmentjobs, skipped))
+	
+	segdir = tmp.mkdtemp(prefix="binauralconv-")
+	segfiles = [join(segdir, "%04d.wv" % i) for i in range(len(plan))]
+	lock = Lock()
+	stop = []
+	failed = []
+	running = set()
+	
+	def parseline (proc, l):
+		with lock:
+			if stop:
+				proc.kill()
+			elif linefunc is not None:
+				linefunc(proc, l)
+	
+	overlap = latency()
+	
+	def convseg (segment, segfile):
+		if stop:
+			return
+		start, end, preroll = segment
+		args = [ffmpeg, "-ss", str(start - preroll)]
+		if end is not None:
+			# Decode past the end as well; the join trims it off again
+			args += ["-t", str(end - start + preroll + overlap)]
+		args += ["-i", concatfile, "-af", graph,
+			"-c:a", "wavpack", "-sample_fmt", "fltp", "-y", segfile]
+		
+		lines = []
+		def seglines (proc, l):
+			lines.append(l)
+			parseline(proc, l)
+		
+		# Any exit code is accepted here, so that a failing segment can stop
+		# the others before convert() gives up
+		returncode = process(args, seglines, None, running)
+		if returncode != 0:
+			# Once a segment fails (e.g. is killed for clipping), kill the rest too
+			with lock:
+				if not stop and returncode not in exitcodes:
+					failed.append((returncode, lines))
+				stop.append(segfile)
+				for proc in list(running):
+					proc.kill()
+	
+	try:
+		with ThreadPoolExecutor(max_workers=segmentjobs) as executor:
+			list(executor.map(convseg, plan, segfiles))
+		if failed:
+			returncode, lines = failed[0]
+			msg = "Process ended unexpectedly (return code %s)" % returncode
+			if not verbose:
+				msg += ":\n%s" % "\n".join(lines)
+			fatal(msg)
+		if stop:
+			return False
+		
+		# Put the segments back on the original timeline, with digital
+		# silence in place of the bypassed regions
+		rate = mg.File(segfiles[0]).info.sample_rate
+		inputs = []
+		pads = []
+		joingraph = ""
+		if plan[0][0] > 0:
+			joingraph += "anullsrc=r=%d:cl=stereo,atrim=end_sample=%d[g];" % (rate, plan[0][0] * rate)
+			pads.append("[g]")
+		for i, ((start, end, preroll), segfile) in enumerate(zip(plan, segfiles)):
+			inputs += ["-i", segfile]
+			if end is None and preroll == 0:
+				pads.append("[%d:a]" % i)
+				continue
+			trim = "start_sample=%d" % (preroll * rate)
+			if end is not None:
+				trim += ":end_sample=%d" % ((end - start + preroll) * rate)
+			joingraph += "[%d:a]atrim=%s,asetpts=PTS-STARTPTS[s%d];" % (i, trim, i)
+			pads.append("[s%d]" % i)
+			if end is not None and plan[i+1][0] > end:
+				joingraph += "anullsrc=r=%d:cl=stereo,atrim=end_sample=%d[g%d];" % (rate, (plan[i+1][0] - end) * rate, i)
+				pads.append("[g%d]" % i)
+		joingraph += "".join(pads) + "concat=n=%d:v=0:a=1" % len(pads)
+		if analysis:
+			joingraph += "," + analysis
+		
+		args = [ffmpeg] + inputs + ["-filter_complex", joingraph] + outargs + [outfile]
+		return process(args, linefunc, exitcodes) == 0
+	finally:
+		rmtree(segdir, ignore_errors=True)
+
 def voldet_parseline (proc, l):
-	global sofagain, volgain, replaygain
+	global volgain, replaygain
 	if ("Parsed_sofalizer" in l or "Parsed_headphone" in l) and "samples clipped" in l:
 		proc.kill()
-		sofagain -= sofagainstep
-		log("Sofalizer gain too high, trying %s dB..." % sofagain)
 		return
 	elif "Parsed_replaygain" in l and "track_gain" in l:
 		replaygain = float(l.split(" ")[-2])
@@ -368,14 +723,15 @@ def voldet_parseline (proc, l):
 		volgain = -float(l.split(" ")[-2]) + volgainoffset
 
 def voldet ():
-	global alimit, replaygain
+	global alimit, replaygain, sofagain
 	
 	mktemp()
 	
 	while volgain is None and replaygain is None and sofagain > 0:
-		args = [ffmpeg, "-i", concatfile, "-af", filtergraph(), 
-			"-c:a", "wavpack", "-sample_fmt", "fltp", "-y", tempfile]
-		process(args, voldet_parseline, (0, -9))
+		if not convert(filtergraph(analyze=False), "volumedetect,replaygain", tempfile,
+				["-c:a", "wavpack", "-sample_fmt", "fltp", "-y"], voldet_parseline, (0, -9)):
+			sofagain -= sofagainstep
+			log("Sofalizer gain too high, trying %s dB..." % sofagain)
 
 	if volgain is None:
 		fatal("Could not find safe volume gain")
@@ -383,7 +739,51 @@ def voldet ():
 	if replaygain is not None and replaygain > volgain and rgnormalize:
 		alimit = True
 
-def bconv ():
+def cuetracks ():
+	starts = []
+	try:
+		with open(cuefile) as f:
+			for line in f:
+				m = re.match(r"\s*INDEX 01 (\d+):(\d+)([.:])(\d+)", line)
+				if m:
+					frac = int(m.group(4)) / (75 if m.group(3) == ":" else 10 ** len(m.group(4)))
+					starts.append(int(m.group(1)) * 60 + int(m.group(2)) + frac)
+	except Exception as e:
+		log("Could not read track boundaries from cue sheet: %s" % repr(e))
+	return starts or [0.0]
+
+def rganalysis (tracks):
+	if len(tracks) < 2:
+		return "replaygain@album"
+	graph = "asplit=%d[rgalbum]" % (len(tracks) + 1)
+	graph += "".join("[rgtrack%d]" % (i + 1) for i in range(len(tracks)))
+	for i, start in enumerate(tracks):
+		trim = "start=%.6f" % start
+		if i + 1 < len(tracks):
+			trim += ":end=%.6f" % tracks[i+1]
+		graph += ";[rgtrack{n}]atrim={trim},replaygain@track{n},anullsink".format(n=i+1, trim=trim)
+	graph += ";[rgalbum]replaygain@album"
+	return graph
+
+def rgparseline (proc, l):
+	m = re.search(r"\[replaygain@(\w+) @ [^]]*\] track_(gain|peak) = ([-+\d.]+)", l)
+	if m:
+		trackgains.setdefault(m.group(1), {})[m.group(2)] = float(m.group(3))
+
+def rgtag (filename, track=None):
+	try:
+		f = mg.File(filename, easy=True)
+		if f is None:
+			return
+		for name, key in (("track", track), ("album", "album")):
+			if key in trackgains:
+				f["replaygain_%s_gain" % name] = "%+.2f dB" % trackgains[key]["gain"]
+				f["replaygain_%s_peak" % name] = "%.6f" % trackgains[key]["peak"]
+		f.save()
+	except Exception as e:
+		log("Could not write ReplayGain tags to %s: %s" % (filename, repr(e)))
+
+def bconv (tracks=(0.0,)):
 	global replaygain
 	
 	if isfile(convfile) and not force:
@@ -405,19 +805,200 @@ def bconv ():
 				gain += replaygain
 				log("Additional gain correction: %.2f (total: %.2f)" % (replaygain, gain))
 		
-		args = [ffmpeg, "-i", tempfile, "-af", outfiltergraph(gain), convfile]
+		graph = outfiltergraph(gain)
+		if trackgain:
+			graph += "," + rganalysis(tracks)
+		args = [ffmpeg, "-i", tempfile, "-af", graph, convfile]
+		if force:
+			args.insert(-1, "-y")
+		process(args, rgparseline)
 	else:
-		args = [ffmpeg, "-i", concatfile, "-af", filtergraph(gain), convfile]
-	
-	if force:
-		args.insert(-1, "-y")
-	process(args)
+		convert(filtergraph(gain), rganalysis(tracks) if trackgain else None, convfile,
+			["-y"] if force else [], rgparseline)
 	
-	if isfile(tempfile):
+	if tempfile is not None and isfile(tempfile):
 		remove(tempfile)
+	
+	if trackgains:
+		for key in sorted(trackgains, key=lambda k: (len(k), k)):
+			log("ReplayGain (%s): %+.2f dB, peak %.6f" % (key, trackgains[key]["gain"], trackgains[key]["peak"]))
+		# A single track has the same track and album values
+		rgtag(convfile, "album" if len(tracks) < 2 else None)
 
 def cuesplit ():
-	process([splitflac, convfile, "-cue", cuefile, "-o", splitoutdir])
+	if not trackgains:
+		process([splitflac, convfile, "-cue", cuefile, "-o", splitoutdir])
+		return
+	
+	# Split into a fresh directory first, so that only this album's tracks get tagged
+	try:
+		makedirs(splitoutdir, exist_ok=True)
+		outdir = tmp.mkdtemp(prefix=".binauralconv-", dir=splitoutdir)
+	except Exception as e:
+		fatal("Could not create split output directory: %s" % repr(e))
+	
+	try:
+		process([splitflac, convfile, "-cue", cuefile, "-o", outdir])
+		for root, dirs, files in walk(outdir):
+			for name in sorted(files):
+				filename = join(root, name)
+				try:
+					f = mg.File(filename, easy=True)
+					number = int(f["tracknumber"][0].split("/")[0])
+				except Exception:
+					number = None
+				if "track%s" % number in trackgains:
+					rgtag(filename, "track%d" % number)
+				
+				target = join(splitoutdir, relpath(filename, outdir))
+				makedirs(dirname(target), exist_ok=True)
+				replace(filename, target)
+	finally:
+		rmtree(outdir, ignore_errors=True)
+
+# Parameters that can be swept in preview mode: option name -> (global, parser)
+sweepparams = {
+	"sofagain":       ("sofagain", float),
+	"lfe-multiplier": ("lfemultiplier", float),
+	"subboost":       ("subboost", isyes),
+	"generate-lfe":   ("generatelfe", isyes),
+	"filter-append":  ("filter_append", str),
+}
+
+# Globals that preview workers need to rebuild the filter graph
+previewsettings = ("quiet", "verbose", "ffmpeg", "sofafile", "eqdelay", "layout",
+	"upmix", "generatelfe", "lfemultiplier", "subboost", "sofagain", "sofalizer",
+	"resampler", "outsamplerate", "filter_append")
+
+def loudness (filename):
+	values = []
+
+	def parseline (proc, l):
+		m = re.search(r"\bt:\s*([\d.]+).*\bM:\s*(-?[\d.]+)", l)
+		if "Parsed_ebur128" in l and m:
+			values.append((float(m.group(1)), float(m.group(2))))
+
+	process([ffmpeg, "-nostats", "-i", filename, "-af", "ebur128", "-f", "null", "-"], parseline)
+	return values
+
+def excerpts (filename):
+	values = loudness(filename)
+	if len(values) < 2 or values[-1][0] <= previewlength:
+		return [(0, None)]
+
+	# Pick the loudest non-overlapping windows by mean momentary loudness
+	step = values[1][0] - values[0][0]
+	width = max(1, int(round(previewlength / step)))
+	sums = [0]
+	for t, m in values:
+		sums.append(sums[-1] + m)
+	starts = sorted(range(len(values) - width + 1), key=lambda i: sums[i] - sums[i+width])
+
+	chosen = []
+	for i in starts:
+		if len(chosen) >= previewcount:
+			break
+		if all(abs(i - j) >= width for j in chosen):
+			chosen.append(i)
+	return [(max(0, values[i][0] - step), previewlength) for i in sorted(chosen)]
+
+def sweeplabel (combo):
+	label = []
+	for name, (var, conv) in sorted(sweepparams.items()):
+		if var not in combo:
+			continue
+		value = combo[var]
+		if var == "filter_append":
+			value = sweep[var].index(value) + 1
+		elif conv is isyes:
+			value = "yes" if value else "no"
+		label.append("%s-%s" % (name, value))
+	return "_".join(label) or "default"
+
+def previewconv (settings, combo, infile, outfile):
+	globals().update(settings)
+	globals().update(combo)
+	stats = {"peak": None, "gain": None, "clipped": 0}
+
+	def parseline (proc, l):
+		m = re.search(r"(\d+) of \d+ samples clipped", l)
+		if ("Parsed_sofalizer" in l or "Parsed_headphone" in l) and m:
+			stats["clipped"] += int(m.group(1))
+		elif "Parsed_replaygain" in l and "track_gain" in l:
+			stats["gain"] = float(l.split(" ")[-2])
+		elif "Parsed_volumedetect" in l and "max_volume" in l:
+			stats["peak"] = float(l.split(" ")[-2])
+
+	args = [ffmpeg, "-i", infile, "-af", filtergraph(),
+		"-c:a", "wavpack", "-sample_fmt", "fltp", "-y", outfile]
+	process(args, parseline)
+	return stats
+
+def preview (files):
+	if not isdir(previewdir):
+		try:
+			mkdir(previewdir)
+		except Exception as e:
+			fatal("Could not create preview directory: %s" % repr(e))
+
+	excerptfile = join(previewdir, "excerpts.flac")
+	infofile = join(previewdir, "excerpts.json")
+	
+	# Only reuse the excerpts if they were taken from the same files with the same settings
+	excerptinfo = {"count": previewcount, "length": previewlength,
+		"files": [[f, stat(f).st_mtime, stat(f).st_size] for f in files]}
+	try:
+		with open(infofile) as f:
+			reusable = json.load(f) == excerptinfo
+	except Exception:
+		reusable = False
+	
+	if isfile(excerptfile) and reusable and not force:
+		log("Excerpt file exists, skipping.")
+	else:
+		inputs = []
+		for f in files:
+			for start, length in excerpts(f):
+				log("Excerpt: %s at %.1f s" % (basename(f), start))
+				inputs += ["-ss", "%.3f" % start]
+				if length is not None:
+					inputs += ["-t", "%.3f" % length]
+				inputs += ["-i", f]
+		count = inputs.count("-i")
+		graph = "".join("[%d:a]" % i for i in range(count)) + "concat=n=%d:v=0:a=1" % count
+		process([ffmpeg] + inputs + ["-filter_complex", graph, "-c:a", "flac", "-y", excerptfile])
+		try:
+			with open(infofile, "w") as f:
+				json.dump(excerptinfo, f)
+		except Exception as e:
+			log("Could not write excerpt info: %s" % repr(e))
+
+	names = sorted(sweep)
+	combos = [dict(zip(names, values)) for values in product(*[sweep[n] for n in names])]
+	labels = [sweeplabel(c) for c in combos]
+	outfiles = [join(previewdir, "%s.wv" % l) for l in labels]
+	settings = dict((name, globals()[name]) for name in previewsettings)
+
+	log("Converting %d parameter combination(s) using %d job(s)..." % (len(combos), jobs))
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		results = list(executor.map(previewconv, [settings]*len(combos), combos,
+			[excerptfile]*len(combos), outfiles))
+
+	width = max(len(l) for l in labels)
+	summary = ["%-*s %10s %10s %10s" % (width, "settings", "peak (dB)", "rg (dB)", "clipped")]
+	for label, stats in zip(labels, results):
+		summary.append("%-*s %10s %10s %10d" % (width, label,
+			"%.2f" % stats["peak"] if stats["peak"] is not None else "-",
+			"%.2f" % stats["gain"] if stats["gain"] is not None else "-",
+			stats["clipped"]))
+	for line in summary:
+		log(line)
+
+	try:
+		with open(join(previewdir, "summary.txt"), "w") as f:
+			f.write("\n".join(summary) + "\n")
+	except Exception as e:
+		fatal("Could not write preview summary: %s" % repr(e))
 
 if __name__ == '__main__':
 	path = None
@@ -428,6 +1009,9 @@ if __name__ == '__main__':
 	dovolgain = True
 	dobconv = True
 	dosplit = True
+	dopreview = False
+	dopreflight = True
+	singlefile = False
 	
 	for arg in sys.argv[1:]:
 		splitarg = arg.split("=", maxsplit=1)
@@ -499,6 +1083,16 @@ Individual steps of the process can be disabled or tuned using these options:
  --ffmpeg=FILE, -ffmpeg=FILE:
   path to FFmpeg executable (currrent: {ffmpeg})
  
+ --ffprobe=FILE, -ffprobe=FILE:
+  path to FFprobe executable (current: {ffprobe})
+ 
+ --no-preflight, -no-preflight:
+  don't probe the input files for consistent channel layout, sampling rate
+  and codec before converting
+ 
+ --probecache=FILE, -probecache=FILE:
+  filename of cached input stream info (current: {probecache})
+ 
  --split2flac=FILE, -split2flac=FILE:
   path to split2flac executable (current: {splitflac})
  
@@ -531,6 +1125,7 @@ Individual steps of the process can be disabled or tuned using these options:
 
  --7.1, -8:
   use 7.1 speaker layout
+  (by default, the layout is chosen from the channel layout of the input)
  
  --generate-lfe, -generate-lfe:
   replace LFE channel with one generated by a lowpass filter (for 5.0 mixes)
@@ -559,6 +1154,46 @@ Individual steps of the process can be disabled or tuned using these options:
  --filter-append=STRING, -filter-append=STRING
   additional FFmpeg filters to add to the end of the conversion filter graph
 
+ --track-gain, -track-gain ||
+ --no-track-gain, -no-track-gain:
+  (do not) measure per-track and album ReplayGain during conversion and
+  write it to the tags of the converted and split files (current: {trackgain})
+
+ --silence-bypass, -silence-bypass ||
+ --no-silence-bypass, -no-silence-bypass:
+  (do not) skip convolution for silent stretches of the input, emitting
+  digital silence once the filter tails have decayed; not available with
+  --sofalizer or --filter-append (current: {silencebypass})
+
+ --silence-threshold=FLT, -silence-threshold=FLT:
+  level (in dB) below which all channels count as silent (current: {silencethreshold})
+
+ --silence-min-length=FLT, -silence-min-length=FLT:
+  minimum length (in seconds) of silence to bypass (current: {silenceminlen})
+
+ --preview, -preview:
+  only convert short excerpts of each track (chosen by loudness) into
+  '{previewdir}/' for every combination of --sweep values, and write a summary
+  table (peak, ReplayGain, clipped samples) to '{previewdir}/summary.txt'
+
+ --preview-count=INT, -preview-count=INT:
+  number of excerpts per track in preview mode (current: {previewcount})
+
+ --preview-length=FLT, -preview-length=FLT:
+  length of each excerpt in seconds in preview mode (current: {previewlength})
+
+ --sweep=NAME=VALUES, -sweep=NAME=VALUES:
+  comma-separated values to try in preview mode for parameter NAME, which is
+  one of: sofagain, lfe-multiplier, subboost, generate-lfe (yes/no values),
+  filter-append (one value per option; repeat the option to add more)
+
+ --jobs=INT, -jobs=INT, -j=INT:
+  number of parallel jobs for preview conversions and input probing (current: {jobs})
+
+ --segment-jobs=INT, -segment-jobs=INT:
+  number of overlapping segments to convert concurrently; not available with
+  --sofalizer or --filter-append (default: --jobs in single file mode, 1 otherwise)
+
  --quiet, -quiet, -q:
   quiet mode
  
@@ -574,7 +1209,13 @@ Individual steps of the process can be disabled or tuned using these options:
 		subboost=("subboost" if subboost else "no-subboost"),
 		sofalizer=("sofalizer" if sofalizer else "no-sofalizer"),
 		normalize=("normalize" if rgnormalize else "no-normalize"),
-		resampler=resampler, outsamplerate=outsamplerate))
+		resampler=resampler, outsamplerate=outsamplerate,
+		previewdir=previewdir, previewcount=previewcount,
+		previewlength=previewlength, jobs=jobs,
+		silencebypass=("silence-bypass" if silencebypass else "no-silence-bypass"),
+		silencethreshold=silencethreshold, silenceminlen=silenceminlen,
+		trackgain=("track-gain" if trackgain else "no-track-gain"),
+		ffprobe=ffprobe, probecache=probecache))
 			sys.exit(0)
 		elif argname in ("--no-concat", "-no-concat", "-t"):
 			doconcat = False
@@ -600,6 +1241,12 @@ Individual steps of the process can be disabled or tuned using these options:
 			logtofile = False
 		elif argname in ("--ffmpeg", "-ffmpeg"):
 			ffmpeg = param
+		elif argname in ("--ffprobe", "-ffprobe"):
+			ffprobe = param
+		elif argname in ("--probecache", "-probecache"):
+			probecache = param
+		elif argname in ("--no-preflight", "-no-preflight"):
+			dopreflight = False
 		elif argname in ("--split2flac", "-split2flac"):
 			splitflac = param
 		elif argname in ("--sofafile", "-sofafile"):
@@ -654,8 +1301,10 @@ Individual steps of the process can be disabled or tuned using these options:
 			force = True
 		elif argname in ("--quad", "-quad", "-4"):
 			layout = "4.0"
+			autolayout = False
 		elif argname in ("--7.1", "-8"):
 			layout = "7.1"
+			autolayout = False
 		elif argname in ("--generate-lfe", "-generate-fle"):
 			generatelfe = True
 		elif argname in ("--lfe-multiplier", "-lfe-multiplier"):
@@ -687,6 +1336,65 @@ Individual steps of the process can be disabled or tuned using these options:
 				log("Invalid value for output sample rate, ignoring")
 		elif argname in ("--filter-append", "-filter-append"):
 			filter_append = param
+		elif argname in ("--preview", "-preview"):
+			doconcat = False
+			domakecue = False
+			dovolgain = False
+			dobconv = False
+			dosplit = False
+			dopreview = True
+		elif argname in ("--preview-count", "-preview-count"):
+			if isint(param) and int(param) > 0:
+				previewcount = int(param)
+			else:
+				log("Invalid value for preview excerpt count, ignoring")
+		elif argname in ("--preview-length", "-preview-length"):
+			if isfloat(param) and float(param) > 0:
+				previewlength = float(param)
+			else:
+				log("Invalid value for preview excerpt length, ignoring")
+		elif argname in ("--sweep", "-sweep"):
+			name, _, values = (param or "").partition("=")
+			if name in sweepparams and values:
+				var, conv = sweepparams[name]
+				values = [values] if name == "filter-append" else values.split(",")
+				try:
+					# Repeated values would give two workers the same output file
+					for v in [conv(v) for v in values]:
+						if v not in sweep.setdefault(var, []):
+							sweep[var].append(v)
+				except ValueError:
+					log("Invalid value for %s sweep, ignoring" % name)
+			else:
+				log("Invalid parameter sweep, ignoring")
+		elif argname in ("--silence-bypass", "-silence-bypass"):
+			silencebypass = True
+		elif argname in ("--no-silence-bypass", "-no-silence-bypass"):
+			silencebypass = False
+		elif argname in ("--silence-threshold", "-silence-threshold"):
+			if isfloat(param):
+				silencethreshold = float(param)
+			else:
+				log("Invalid value for silence threshold, ignoring")
+		elif argname in ("--silence-min-length", "-silence-min-length"):
+			if isfloat(param) and float(param) > 0:
+				silenceminlen = float(param)
+			else:
+				log("Invalid value for minimum silence length, ignoring")
+		elif argname in ("--track-gain", "-track-gain"):
+			trackgain = True
+		elif argname in ("--no-track-gain", "-no-track-gain"):
+			trackgain = False
+		elif argname in ("--segment-jobs", "-segment-jobs"):
+			if isint(param) and int(param) > 0:
+				segmentjobs = int(param)
+			else:
+				log("Invalid value for segment job count, ignoring")
+		elif argname in ("--jobs", "-jobs", "-j"):
+			if isint(param) and int(param) > 0:
+				jobs = int(param)
+			else:
+				log("Invalid value for job count, ignoring")
 		elif isdir(argname):
 			path = abspath(argname)
 			break
@@ -697,6 +1405,7 @@ Individual steps of the process can be disabled or tuned using these options:
 			doconcat = False
 			domakecue = False
 			dosplit = False
+			singlefile = True
 			log("Enabling single file mode for '{filename}' (output filename: {convfile})".format(filename=argname, convfile=convfile))
 		else:
 			log("Unknown argument: %s" % arg)
@@ -704,13 +1413,19 @@ Individual steps of the process can be disabled or tuned using these options:
 	if path is None:
 		path = abspath(".")
 	
-	if (doconcat or dovolgain or dobconv) and not which(ffmpeg):
+	if segmentjobs is None:
+		segmentjobs = jobs if singlefile else 1
+	
+	if (doconcat or dovolgain or dobconv or dopreview) and not which(ffmpeg):
 		fatal("Wrong FFmpeg path: %s" % ffmpeg)
 	
+	if dopreflight and (doconcat or dovolgain or dobconv or dopreview) and not (ffprobe and which(ffprobe)):
+		fatal("Wrong FFprobe path: %s (use --no-preflight to skip input checks)" % ffprobe)
+	
 	if dosplit and not which(splitflac):
 		fatal("Wrong split2flac path: %s" % splitflac)
 	
-	if (dovolgain or dobconv) and not isfile(sofafile):
+	if (dovolgain or dobconv or dopreview) and not isfile(sofafile):
 		fatal("SOFA file not found.")
 	
 	if wdir is None:
@@ -727,6 +1442,11 @@ Individual steps of the process can be disabled or tuned using these options:
 	if logtofile:
 		sys.stdout = Logger()
 	
+	if dopreflight and (doconcat or dovolgain or dobconv or dopreview):
+		log("### Checking input...")
+		preflight(filelist() if (doconcat or dopreview) and not singlefile else [realpath(concatfile)])
+		log("### Checking input - done.")
+	
 	log("Path: %s" % path)
 	log("Wdir: %s" % wdir)
 	log("Layout: %s" % layout)
@@ -736,6 +1456,13 @@ Individual steps of the process can be disabled or tuned using these options:
 	log("LFE multiplier: %.2f" % lfemultiplier)
 	log("Sofalizer? %s" % ("yes" if sofalizer else "no"))
 	log("Resampler: %s" % resampler)
+	log("Silence bypass? %s" % ("yes" if silencebypass and cansegment() else "no"))
+	log("Segment jobs: %d" % (segmentjobs if cansegment() else 1))
+	
+	if dopreview:
+		log("### Previewing...")
+		preview([concatfile] if singlefile else filelist())
+		log("### Previewing - done.")
 	
 	if domakecue:
 		log("### Making CUE sheet...")
@@ -754,7 +1481,7 @@ Individual steps of the process can be disabled or tuned using these options:
 	
 	if dobconv:
 		log("### Converting (pass 2)... (sampling rate: %d Hz)" % outsamplerate)
-		bconv()
+		bconv([0.0] if singlefile else cuetracks())
 		log("### Converting (pass 2) - done.")
 	
 	if dosplit: